@@ -1,12 +1,19 @@
 import os
-import requests
-import base64
-import traceback
-import sys
-import json
-from flask import Flask, request, Response, jsonify
+import asyncio
+import functools
+import hashlib
+import logging
+import re
+import time
+import httpx
+import orjson
+from contextlib import contextmanager
+from quart import Quart, request, Response
+from cachetools import TTLCache
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
 import google.generativeai as genai
-from PIL import Image
+from PIL import Image, ImageFile, ImageOps
 from io import BytesIO
 from dotenv import load_dotenv
 
@@ -14,7 +21,37 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # --- Application Setup ---
-app = Flask(__name__)
+app = Quart(__name__)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Metrics ---
+# How long each phase of a request takes (image download, reference image
+# download, resize, Gemini call, response parsing), labelled by phase and OCR
+# approach, so optimisation can target where the time actually goes.
+# Exposed in the Prometheus format on /metrics.
+PHASE_DURATION = Histogram(
+    'ocr_phase_duration_seconds',
+    'Time spent in each phase of an extraction request',
+    ['phase', 'approach'],
+)
+CACHE_LOOKUPS = Counter(
+    'ocr_cache_lookups_total',
+    'Reference image and extraction cache lookups by outcome',
+    ['cache', 'result'],
+)
+
+@contextmanager
+def timed(phase):
+    """Record how long the enclosed block takes under the given phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_DURATION.labels(phase=phase, approach=OCR_APPROACH).observe(elapsed)
+        logger.info("%s took %.1f ms", phase, elapsed * 1000, extra={'phase': phase, 'ms': elapsed * 1000})
 
 # --- API Key Configuration ---
 # IMPORTANT: It's best practice to set your API key as an environment variable
@@ -28,8 +65,8 @@ try:
         raise ValueError("GOOGLE_API_KEY environment variable not set.")
     genai.configure(api_key=api_key)
 except ValueError as e:
-    print(f"Error: {e}")
-    print("Please set your GOOGLE_API_KEY environment variable.")
+    logger.error("Error: %s", e)
+    logger.error("Please set your GOOGLE_API_KEY environment variable.")
     # You can also hardcode it here for quick testing, but this is NOT recommended for production:
     # api_key = "YOUR_API_KEY_GOES_HERE" 
     # genai.configure(api_key=api_key)
@@ -55,14 +92,366 @@ OCR_APPROACH = os.environ.get('OCR_APPROACH', 'direct')
 # This avoids issues with base64 encoding in the deployed environment
 REFERENCE_IMAGE_URL = "https://xpertlink.agency/wp-content/uploads/2025/08/רישוי_שנתי.jpg"
 
+# --- Prompts ---
+# Instructions for the reference-based approach: learn where the fields are on
+# the reference image, then read the same locations on the new image.
+REFERENCE_BASED_PROMPT = """
+You are an expert document analysis assistant. Your task is to first learn the spatial location of fields from a reference document using the provided text and example values. Then, you must find the data at those *exact same spatial locations* in a new, second document.
+
+Here are your instructions for learning from the reference document: From the reference image, learn the locations of the following fields: 'דגם' is 'GD9EL5R', 'רמת גימור' is 'GX', 'כינוי מסחרי' and 'תוצר'.
+
+Now, using the locations you have just learned, analyze the new document and extract the corresponding values.
+
+Your output must be a valid JSON object with the following structure:
+{
+    "דגם": "[extracted model value]",
+    "רמת גימור": "[extracted trim level value]",
+    "כינוי מסחרי": "[extracted commercial name]",
+    "תוצר": "[extracted producer name]"
+}
+
+Do not include any other text or formatting outside of this JSON structure.
+"""
+
+# Instructions for the direct approach, which sends only the new image
+DIRECT_PROMPT = """
+You are an expert document analysis assistant for vehicle registration documents in Hebrew. 
+
+Analyze the provided image of a vehicle registration document and extract the following fields:
+1. 'דגם' (Model) - This field appears on the document and contains the vehicle model code.
+2. 'רמת גימור' (Trim Level) - This field appears on the document and contains the trim level code.
+3. 'כינוי מסחרי' (Commercial Name) - This field appears on the document and contains the commercial name.
+4. 'תוצר' (Producer) - This field appears on the document and contains the producer/manufacturer name.
+
+Your output must be a valid JSON object with the following structure:
+{
+    "דגם": "[extracted model value]",
+    "רמת גימור": "[extracted trim level value]",
+    "כינוי מסחרי": "[extracted commercial name]",
+    "תוצר": "[extracted producer name]"
+}
+
+Do not include any other text or formatting outside of this JSON structure.
+"""
+
 # --- Gemini Model ---
 # Using a model that is good for multimodal tasks.
 # Using flash model due to quota limitations with pro
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Set GEMINI_MODEL to try a different model without a code change.
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash')
+
+@functools.lru_cache(maxsize=1)
+def get_model():
+    """
+    Return the shared Gemini model, creating it on first use. Nothing is set
+    up at import time, so a Gunicorn master that preloads the app doesn't
+    create SDK state that its forked workers would inherit.
+    """
+    return genai.GenerativeModel(GEMINI_MODEL)
+
+# Gemini sometimes wraps its JSON answer in a markdown code block
+# (```json ... ```). This captures what's inside, with the opening and closing
+# fences each optional so that a truncated reply missing its closing fence
+# still parses.
+JSON_FENCE_RE = re.compile(r"^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$", re.DOTALL | re.IGNORECASE)
+
+def strip_json_fence(text):
+    """Return the JSON text of a model response without any code fence around it."""
+    return JSON_FENCE_RE.match(text).group(1)
+
+# --- HTTP Client ---
+# A single async client is shared by all requests so that the image downloads
+# don't tie up a worker thread while waiting on the network. Its connection
+# pool keeps connections open between requests, so repeat downloads from the
+# same host skip the TCP and TLS handshakes. HTTP/2 is used when the server
+# supports it, which lets concurrent downloads from one host share a single
+# connection. A failed connection attempt is retried once before the request
+# gives up. Connecting has its own short timeout, so an unreachable host costs
+# at most (1 + retries) * 3 s per request instead of blocking for the full
+# 10 s read timeout on each attempt.
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 50
+HTTP_TIMEOUT = 10
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_CONNECT_RETRIES = 1
+
+@functools.lru_cache(maxsize=1)
+def get_http_client():
+    """
+    Return the shared HTTP client, creating it on first use. As with the model,
+    each worker gets its own client and connection pool after the fork.
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        follow_redirects=True,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+            retries=HTTP_CONNECT_RETRIES,
+        ),
+    )
+
+@app.after_serving
+async def close_http_client():
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+
+# --- Image Downloads ---
+# Images are streamed in chunks and the download is aborted as soon as it
+# passes this size, so an oversized URL can't exhaust the worker's memory.
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Timeout for the HEAD request that checks the image URL before downloading
+PROBE_TIMEOUT = 5
+
+class ImageTooLargeError(Exception):
+    """Raised when an image is larger than MAX_IMAGE_BYTES."""
+
+    def __init__(self):
+        super().__init__(f"Image is larger than the {MAX_IMAGE_BYTES // (1024 * 1024)} MB limit")
+
+class InvalidImageURLError(Exception):
+    """Raised when an image URL is missing or doesn't point to an image."""
+
+async def probe_image_url(url):
+    """
+    Check the image URL with a HEAD request so that missing, non-image and
+    oversized URLs are rejected before anything is downloaded. Servers that
+    don't answer HEAD properly (presigned URLs are often signed for GET only,
+    some time out or drop the connection) get the benefit of the doubt, and
+    the download checks the size again.
+    """
+    try:
+        with timed('image_probe'):
+            response = await get_http_client().head(url, timeout=httpx.Timeout(PROBE_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+    except httpx.HTTPError as e:
+        logger.info("HEAD request failed, trying the download anyway: %s", e)
+        return
+
+    if response.status_code in (404, 410):
+        raise InvalidImageURLError(f"Image not found at URL (HTTP {response.status_code})")
+    if response.status_code != 200:
+        return
+
+    # Some storage services label every file application/octet-stream, and
+    # S3 defaults to binary/octet-stream
+    content_type = response.headers.get('Content-Type', '').lower()
+    if content_type and not content_type.startswith(('image/', 'application/octet-stream', 'binary/octet-stream')):
+        raise InvalidImageURLError(f"URL does not point to an image (Content-Type: {content_type})")
+
+    content_length = response.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+        raise ImageTooLargeError()
+
+async def probe_and_fetch_image(url):
+    """Check the image URL and, if it looks valid, download the image."""
+    await probe_image_url(url)
+    return await fetch_image(url)
+
+async def fetch_image(url, phase='image_fetch'):
+    """Download an image and return its raw bytes."""
+    with timed(phase):
+        async with get_http_client().stream('GET', url) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+
+            # Reject up front when the server already tells us the size
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+                raise ImageTooLargeError()
+
+            image_buffer = BytesIO()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                image_buffer.write(chunk)
+                if image_buffer.tell() > MAX_IMAGE_BYTES:
+                    raise ImageTooLargeError()
+            return image_buffer.getvalue()
+
+def image_part(image_bytes, mime_type):
+    """
+    Wrap raw image bytes as an inline Gemini content part. Gemini accepts the
+    encoded file as-is, so the image never has to be decoded by PIL and
+    re-encoded by the SDK.
+    """
+    return {"mime_type": mime_type, "data": image_bytes}
+
+# --- Image Preparation ---
+# Reading a few short fields doesn't need a full-resolution phone photo.
+# Images whose longest edge is above this are shrunk before upload, which
+# means fewer bytes to send and fewer image tokens for Gemini to process.
+MAX_IMAGE_EDGE = 1600
+DOWNSCALED_JPEG_QUALITY = 85
+
+# Formats (as identified by PIL) that Gemini accepts as-is, with the MIME type
+# to send them under. MPO is the multi-picture JPEG many phone cameras write.
+# Anything else PIL can decode (GIF, BMP, TIFF, ...) is re-encoded as JPEG.
+GEMINI_IMAGE_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'MPO': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+# Decoding guards. PIL warns above MAX_IMAGE_PIXELS and refuses images more
+# than twice that size, which stops decompression bombs that fit inside the
+# download size cap. Truncated files (an upload cut short) are decoded as far
+# as the data goes instead of failing the request.
+Image.MAX_IMAGE_PIXELS = 50_000_000
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+def prepare_image(image_bytes):
+    """
+    Return the bytes and MIME type to send to Gemini for an image. Small
+    images in a format Gemini accepts are returned unchanged; anything else
+    becomes a JPEG whose longest edge is at most MAX_IMAGE_EDGE. Raises
+    PIL.UnidentifiedImageError if the bytes aren't an image PIL recognises.
+    """
+    # Opening only parses the header, so small images are never decoded. The
+    # format PIL identifies from the file's contents decides the MIME type,
+    # rather than whatever Content-Type the server sent.
+    image = Image.open(BytesIO(image_bytes))
+    mime_type = GEMINI_IMAGE_MIME_TYPES.get(image.format)
+    if mime_type and max(image.size) <= MAX_IMAGE_EDGE:
+        return image_bytes, mime_type
+
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+    # The EXIF orientation tag is not carried over to the new JPEG, so apply it
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        # JPEG has no alpha, and converting would turn transparent pixels
+        # black, so flatten onto white as the document would look on paper
+        image = image.convert('RGBA')
+        flattened = Image.new('RGB', image.size, 'white')
+        flattened.paste(image, mask=image.getchannel('A'))
+        image = flattened
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=DOWNSCALED_JPEG_QUALITY)
+    return output.getvalue(), 'image/jpeg'
+
+# --- Reference Image Cache ---
+# The reference image is the same for every request, so it is downloaded once
+# and its Gemini content part is kept in memory. The entry expires after an
+# hour so a replaced upstream file is eventually picked up.
+REFERENCE_IMAGE_TTL = 3600
+_reference_image_cache = TTLCache(maxsize=1, ttl=REFERENCE_IMAGE_TTL)
+_reference_image_lock = asyncio.Lock()
+
+async def get_reference_image_part():
+    """Return the reference image content part, downloading it on a cache miss."""
+    reference_part = _reference_image_cache.get(REFERENCE_IMAGE_URL)
+    if reference_part is not None:
+        CACHE_LOOKUPS.labels(cache='reference_image', result='hit').inc()
+        return reference_part
+
+    # Only one request downloads the image; the others wait for it here
+    async with _reference_image_lock:
+        reference_part = _reference_image_cache.get(REFERENCE_IMAGE_URL)
+        if reference_part is None:
+            CACHE_LOOKUPS.labels(cache='reference_image', result='miss').inc()
+            logger.info("Fetching reference image from URL...")
+            reference_bytes = await fetch_image(REFERENCE_IMAGE_URL, phase='reference_fetch')
+            reference_part = image_part(*await asyncio.to_thread(prepare_image, reference_bytes))
+            _reference_image_cache[REFERENCE_IMAGE_URL] = reference_part
+            logger.info("Reference image fetched successfully")
+        else:
+            CACHE_LOOKUPS.labels(cache='reference_image', result='hit').inc()
+    return reference_part
+
+async def preload_reference_image():
+    """
+    Download the reference image ahead of the first request. If this fails,
+    the next request retries the download.
+    """
+    try:
+        await get_reference_image_part()
+    except Exception as e:
+        logger.warning("Could not preload reference image: %s", e)
+
+@app.before_serving
+async def start_reference_image_preload():
+    """
+    Start preloading the reference image in the background. Startup doesn't
+    wait for it, so a slow or unreachable reference host can't keep the
+    worker from serving (or from reporting to Gunicorn in time). Requests
+    that arrive while it is still downloading wait on the cache lock.
+    """
+    if OCR_APPROACH == 'reference_based':
+        app.add_background_task(preload_reference_image)
+
+# --- Extraction Cache ---
+# Serialized JSON responses are cached by a SHA-256 of the image bytes, so an
+# image that was already processed (under any URL) is answered without calling
+# Gemini again. Keys include the OCR approach so results from the two prompts
+# never mix. Perceptual hashes are deliberately not used: two different
+# documents printed on the same form look alike but carry different values.
+EXTRACTION_CACHE_SIZE = 10_000
+EXTRACTION_CACHE_TTL = 3600
+_extraction_cache = TTLCache(maxsize=EXTRACTION_CACHE_SIZE, ttl=EXTRACTION_CACHE_TTL)
 
-# --- Flask Routes ---
+# --- In-Flight Gemini Calls ---
+# Identical images that arrive while the first one is still being processed
+# would otherwise each start their own Gemini call before the cache is filled.
+# Instead, every request for the same cache key awaits the one call in flight.
+_in_flight_calls = {}
+
+async def generate_once(cache_key, parts):
+    """Run a Gemini call, sharing it with concurrent requests for the same key."""
+    call = _in_flight_calls.get(cache_key)
+    if call is None:
+        call = asyncio.ensure_future(get_model().generate_content_async(parts))
+        _in_flight_calls[cache_key] = call
+        call.add_done_callback(lambda _: _in_flight_calls.pop(cache_key, None))
+    else:
+        logger.info("Waiting for an identical request already sent to Gemini")
+    # Shielded so that one client disconnecting doesn't cancel the call for
+    # everyone else waiting on it
+    return await asyncio.shield(call)
+
+async def run_gemini(cache_key, parts):
+    """
+    Send the content parts to Gemini and return the extracted fields as a JSON
+    response, or a plain-text error response if the call or parsing fails.
+    Successful responses are stored in the extraction cache.
+    """
+    try:
+        logger.info("Sending request to Gemini API (%s approach)...", OCR_APPROACH)
+        logger.info("API Key configured: %s", 'Yes' if os.environ.get('GOOGLE_API_KEY') else 'No')
+        with timed('gemini_call'):
+            api_response = await generate_once(cache_key, parts)
+        
+        with timed('response_parse'):
+            # Parse the response as JSON
+            # The response might be wrapped in a markdown code block, so we need to extract just the JSON
+            response_text = strip_json_fence(api_response.text)
+            
+            # Parse the JSON
+            json_data = orjson.loads(response_text)
+            response_body = orjson.dumps(json_data)
+        _extraction_cache[cache_key] = response_body
+        
+        # Return the JSON response
+        return Response(response_body, mimetype='application/json')
+    except orjson.JSONDecodeError as e:
+        # Handle JSON parsing errors
+        error_msg = f"Error parsing JSON response: {str(e)}\nResponse text: {api_response.text}"
+        logger.error(error_msg)
+        return Response(error_msg, status=500, mimetype='text/plain; charset=utf-8')
+    except Exception as e:
+        # Get detailed error information
+        error_type = type(e).__name__
+        error_msg = str(e)
+        
+        # Log the error details along with the stack trace
+        logger.exception("Error communicating with the AI model: %s: %s", error_type, error_msg)
+        
+        # Return a more informative error response
+        return Response(f"Error communicating with the AI model:\nError Type: {error_type}\nError Message: {error_msg}", status=500, mimetype='text/plain; charset=utf-8')
+
+# --- Routes ---
 @app.route('/', methods=['GET'])
-def index():
+async def index():
     """
     Root endpoint that provides basic information about the API.
     """
@@ -109,8 +498,21 @@ def index():
     """
     return Response(welcome_message, mimetype='text/html')
 
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """
+    Prometheus endpoint with the per-phase request timings and cache hit counts.
+    """
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Under Gunicorn every worker writes its samples to this directory, so
+        # merge them to report on all workers rather than the one answering
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
 @app.route('/extract', methods=['GET'])
-def extract_document_fields():
+async def extract_document_fields():
     """
     This endpoint receives a URL to an image, fetches it, and uses Gemini
     to extract fields based on a reference image.
@@ -120,164 +522,72 @@ def extract_document_fields():
     if not image_url:
         return Response("Error: Please provide an 'image_url' parameter.", status=400, mimetype='text/plain')
 
+    # 2. Fetch the new image from the provided URL. When the reference image
+    # isn't cached yet it is fetched at the same time so the two downloads
+    # overlap instead of waiting on each other.
+    downloads = [probe_and_fetch_image(image_url)]
+    if OCR_APPROACH == 'reference_based':
+        downloads.append(get_reference_image_part())
+    results = await asyncio.gather(*downloads, return_exceptions=True)
+
     try:
-        # 2. Fetch the new image from the provided URL
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-        new_image_bytes = response.content
-        new_image = Image.open(BytesIO(new_image_bytes))
+        if isinstance(results[0], Exception):
+            raise results[0]
+        new_image_bytes = results[0]
 
-    except requests.exceptions.RequestException as e:
+    except ImageTooLargeError as e:
+        return Response(f"Error: {e}", status=413, mimetype='text/plain')
+    except InvalidImageURLError as e:
+        return Response(f"Error: {e}", status=400, mimetype='text/plain')
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
         return Response(f"Error fetching image from URL: {e}", status=400, mimetype='text/plain')
     except Exception as e:
         return Response(f"Error processing image: {e}", status=500, mimetype='text/plain')
 
-        # 3. Choose OCR approach based on feature toggle
+    cache_key = f"{OCR_APPROACH}:{hashlib.sha256(new_image_bytes).hexdigest()}"
+    cached_body = _extraction_cache.get(cache_key)
+    if cached_body is not None:
+        CACHE_LOOKUPS.labels(cache='extraction', result='hit').inc()
+        logger.info("Returning cached extraction result")
+        return Response(cached_body, mimetype='application/json')
+    CACHE_LOOKUPS.labels(cache='extraction', result='miss').inc()
+
+    try:
+        # Resizing is CPU-bound, so keep it off the event loop
+        with timed('image_resize'):
+            new_image_part = image_part(*await asyncio.to_thread(prepare_image, new_image_bytes))
+    except Image.DecompressionBombError as e:
+        return Response(f"Error: {e}", status=413, mimetype='text/plain')
+    except Exception as e:
+        return Response(f"Error processing image: {e}", status=500, mimetype='text/plain')
+
+    # 3. Choose OCR approach based on feature toggle
     if OCR_APPROACH == 'reference_based':
         # Original approach with reference image
-        try:
-            print("Using reference-based OCR approach")
-            print("Fetching reference image from URL...")
-            reference_response = requests.get(REFERENCE_IMAGE_URL, timeout=10)
-            reference_response.raise_for_status()
-            reference_image = Image.open(BytesIO(reference_response.content))
-            print("Reference image fetched successfully")
-        except Exception as e:
-            error_msg = f"Error fetching reference image: {str(e)}"
-            print(error_msg)
+        logger.info("Using reference-based OCR approach")
+        if isinstance(results[1], Exception):
+            error_msg = f"Error fetching reference image: {str(results[1])}"
+            logger.error(error_msg)
             return Response(error_msg, status=500, mimetype='text/plain')
-
-        # 4. Define the prompt with specific instructions for the AI with JSON output
-        prompt = """
-You are an expert document analysis assistant. Your task is to first learn the spatial location of fields from a reference document using the provided text and example values. Then, you must find the data at those *exact same spatial locations* in a new, second document.
-
-Here are your instructions for learning from the reference document: From the reference image, learn the locations of the following fields: 'דגם' is 'GD9EL5R', 'רמת גימור' is 'GX', 'כינוי מסחרי' and 'תוצר'.
-
-Now, using the locations you have just learned, analyze the new document and extract the corresponding values.
-
-Your output must be a valid JSON object with the following structure:
-{
-    "דגם": "[extracted model value]",
-    "רמת גימור": "[extracted trim level value]",
-    "כינוי מסחרי": "[extracted commercial name]",
-    "תוצר": "[extracted producer name]"
-}
-
-Do not include any other text or formatting outside of this JSON structure.
-"""
-
-        try:
-            # 5. Send the request to the Gemini API
-            print("Sending request to Gemini API...")
-            print(f"API Key configured: {'Yes' if os.environ.get('GOOGLE_API_KEY') else 'No'}")
-            api_response = model.generate_content([prompt, reference_image, new_image])
-            
-            # Parse the response as JSON
-            # The response might have code blocks or other formatting, so we need to extract just the JSON
-            response_text = api_response.text.strip()
-            # Remove any markdown code block markers if present
-            if response_text.startswith('```json'):
-                response_text = response_text.replace('```json', '', 1)
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
-            
-            # Parse the JSON
-            json_data = json.loads(response_text)
-            
-            # Return the JSON response
-            return jsonify(json_data)
-        except json.JSONDecodeError as e:
-            # Handle JSON parsing errors
-            error_msg = f"Error parsing JSON response: {str(e)}\nResponse text: {api_response.text}"
-            print(error_msg)
-            return Response(error_msg, status=500, mimetype='text/plain; charset=utf-8')
-        except Exception as e:
-            # Get detailed error information
-            error_type = type(e).__name__
-            error_msg = str(e)
-            stack_trace = traceback.format_exc()
-            
-            # Log the error details
-            print(f"Error Type: {error_type}")
-            print(f"Error Message: {error_msg}")
-            print(f"Stack Trace: {stack_trace}")
-            
-            # Return a more informative error response
-            return Response(f"Error communicating with the AI model:\nError Type: {error_type}\nError Message: {error_msg}", status=500, mimetype='text/plain; charset=utf-8')
-            
+        parts = [REFERENCE_BASED_PROMPT, results[1], new_image_part]
     else:  # OCR_APPROACH == 'direct'
         # New approach without reference image
-        print("Using direct OCR approach without reference image")
-        
-        # Define a simpler prompt that directly asks for field extraction with JSON output
-        prompt = """
-You are an expert document analysis assistant for vehicle registration documents in Hebrew. 
-
-Analyze the provided image of a vehicle registration document and extract the following fields:
-1. 'דגם' (Model) - This field appears on the document and contains the vehicle model code.
-2. 'רמת גימור' (Trim Level) - This field appears on the document and contains the trim level code.
-3. 'כינוי מסחרי' (Commercial Name) - This field appears on the document and contains the commercial name.
-4. 'תוצר' (Producer) - This field appears on the document and contains the producer/manufacturer name.
+        logger.info("Using direct OCR approach without reference image")
+        parts = [DIRECT_PROMPT, new_image_part]
 
-Your output must be a valid JSON object with the following structure:
-{
-    "דגם": "[extracted model value]",
-    "רמת גימור": "[extracted trim level value]",
-    "כינוי מסחרי": "[extracted commercial name]",
-    "תוצר": "[extracted producer name]"
-}
-
-Do not include any other text or formatting outside of this JSON structure.
-"""
-
-        try:
-            # Send the request to the Gemini API with only the new image
-            print("Sending request to Gemini API with direct approach...")
-            print(f"API Key configured: {'Yes' if os.environ.get('GOOGLE_API_KEY') else 'No'}")
-            api_response = model.generate_content([prompt, new_image])
-            
-            # Parse the response as JSON
-            # The response might have code blocks or other formatting, so we need to extract just the JSON
-            response_text = api_response.text.strip()
-            # Remove any markdown code block markers if present
-            if response_text.startswith('```json'):
-                response_text = response_text.replace('```json', '', 1)
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
-            
-            # Parse the JSON
-            json_data = json.loads(response_text)
-            
-            # Return the JSON response
-            return jsonify(json_data)
-        except json.JSONDecodeError as e:
-            # Handle JSON parsing errors
-            error_msg = f"Error parsing JSON response: {str(e)}\nResponse text: {api_response.text}"
-            print(error_msg)
-            return Response(error_msg, status=500, mimetype='text/plain; charset=utf-8')
-        except Exception as e:
-            # Get detailed error information
-            error_type = type(e).__name__
-            error_msg = str(e)
-            stack_trace = traceback.format_exc()
-            
-            # Log the error details
-            print(f"Error Type: {error_type}")
-            print(f"Error Message: {error_msg}")
-            print(f"Stack Trace: {stack_trace}")
-            
-            # Return a more informative error response
-            return Response(f"Error communicating with the AI model:\nError Type: {error_type}\nError Message: {error_msg}", status=500, mimetype='text/plain; charset=utf-8')
-        
+    # 4. Send the request to the Gemini API and return the extracted fields
+    return await run_gemini(cache_key, parts)
 
 
 # --- Run the Application ---
+# In production the app is served by Gunicorn with Uvicorn workers (see
+# gunicorn_conf.py). Running this file directly starts a single Uvicorn worker
+# for local development.
 if __name__ == '__main__':
+    import uvicorn
+
     # Get port from environment variable (Heroku sets this automatically)
     port = int(os.environ.get("PORT", 5000))
     
     # In production, host should be '0.0.0.0' to accept connections from any IP
-    # Debug mode should be turned off in production
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    uvicorn.run("app:app", host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+Gunicorn settings for serving the app in production:
+
+    gunicorn -c gunicorn_conf.py app:app
+"""
+import multiprocessing
+import os
+
+# Heroku tells the app which port to listen on through $PORT
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# One async Uvicorn worker per CPU. Heroku sets WEB_CONCURRENCY to suit the
+# dyno size, so it takes precedence when present.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'uvicorn_worker.UvicornWorker'
+
+# Import the app (Quart, the Gemini SDK, Pillow) once in the master process
+# and fork the workers from it, so they start without re-importing and share
+# the loaded modules' memory copy-on-write. Network clients are only opened
+# once a worker starts serving, so nothing connected is shared across forks.
+preload_app = True
+
+def child_exit(server, worker):
+    """Drop an exited worker's live metrics when multiprocess metrics are on."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)